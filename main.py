@@ -1,9 +1,33 @@
+import sys
 import time
 import threading
 
+# Per-thread storage used to cache values that never change for the lifetime of a thread.
+_tls = threading.local()
+
+
+def _thread_name():
+    """
+    Return the name of the current thread, looking it up only on the first call made from each thread.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    A string containing the name of the current thread.
+    """
+    name = getattr(_tls, 'name', None)
+    if name is None:
+        name = _tls.name = threading.current_thread().name
+    return name
+
 class RequestTokenBucket(object):
     """
     A class that models a token bucket to be used for rate limiting purposes.
+    The bucket is implemented with the Generic Cell Rate Algorithm (GCRA), which behaves like a token bucket but only needs to store
+    a single timestamp, the theoretical arrival time, instead of a token count and the time of the last request.
 
     Attributes
     ----------
@@ -13,29 +37,33 @@ class RequestTokenBucket(object):
     refill_rate : int
         The number of seconds it takes for a single token to be refilled into the RequestTokenBucket object.
         Defaults to 5.
-    last_request_timestamp : int
-        A timestamp of the last time a request was allowed by the bucket, represented as seconds since epoch.
+    theoretical_arrival_time : int
+        The time at which the bucket would be completely full again if no further requests were made, represented as nanoseconds on
+        the monotonic clock. Any value in the past means the bucket is full.
     current_count : int
-        The current number of tokens in the bucket.
+        The current number of tokens in the bucket, calculated from the theoretical_arrival_time. Read-only.
     lock : Lock
         A Lock object that allows the bucket to be locked when multiple threads might be trying to make requests.
 
     Methods
     -------
-    calculate_current_tokens():
-        Determine the number of tokens a RequestTokenBucket object should have and set the object's current_count attribute to that value.
-        Return without setting the current_count value if the RequestTokenBucket object does not have a last_request_timestamp value, as
-        we assume this to mean no requests have been made to the bucket yet, and buckets are full of tokens when instantiated.
+    calculate_current_tokens(now):
+        Return the number of tokens a RequestTokenBucket object currently has, based on how far its theoretical_arrival_time is in the future.
+
+    try_consume(now):
+        Remove a single token from the bucket if one is available, in a thread-safe manner, and return the number of tokens left.
     
     print_bucket_summary():
-        Print a formatted summary of the max token capacity, refill rate, current token count, and last request time of a RequestTokenBucket object.
+        Print a formatted summary of the max token capacity, refill rate, current token count, and the number of seconds until a RequestTokenBucket object is full.
     """
 
+    # Buckets are created per account, so slots keep each instance small and make attribute access cheaper.
+    __slots__ = ('max_tokens', 'refill_rate', 'theoretical_arrival_time', 'lock', '_refill_ns', '_burst_ns')
+
     def __init__(self, max_tokens=10, refill_rate=5):
         """
         Constructor for RequestTokenBucket objects.
-        Initialize the last_request_timestamp attribute as None because we could not have made a request to a bucket that did not exist before.
-        Initialize the current_count attribute to the value of max_tokens, as we want the RequestTokenBucket object to be full when instantiated.
+        Initialize the theoretical_arrival_time attribute to the current time, as we want the RequestTokenBucket object to be full when instantiated.
 
         Parameters
         ----------
@@ -48,64 +76,72 @@ class RequestTokenBucket(object):
         """
         self.max_tokens = max_tokens
         self.refill_rate = refill_rate
-        self.last_request_timestamp = None
-        self.current_count = max_tokens
+        self.theoretical_arrival_time = time.monotonic_ns()
+        # A plain Lock is already cheap here: acquiring an uncontended Lock is a single atomic operation with no system call,
+        # while a spinlock written in Python would busy-wait holding the GIL and starve the thread it is waiting on.
         self.lock = threading.Lock()
+        # Each allowed request pushes the theoretical arrival time forward by one refill interval, and a request is only
+        # allowed while the theoretical arrival time stays within max_tokens refill intervals of the current time.
+        self._refill_ns = refill_rate * 1_000_000_000
+        self._burst_ns = max_tokens * self._refill_ns
 
-    def calculate_current_tokens(self):
+    @property
+    def current_count(self):
         """
-        Determine the number of tokens a RequestTokenBucket object should have and set the object's current_count attribute to that value.
-        Return without setting the current_count value if the RequestTokenBucket object does not have a last_request_timestamp value, as
-        we assume this to mean no requests have been made to the bucket yet, and buckets are full of tokens when instantiated.
-
-        Parameters
-        ----------
-        None
-
-        Returns
-        -------
-        None
+        The current number of tokens in the bucket. See calculate_current_tokens().
         """
-        if self.last_request_timestamp is None:
-            return
-        tokens_since_last_request = self.__time_since_last_request() // self.refill_rate
-        self.current_count = min(self.max_tokens, self.current_count + tokens_since_last_request)
-    
-    def print_bucket_summary(self):
+        return self.calculate_current_tokens(time.monotonic_ns())
+
+    def calculate_current_tokens(self, now):
         """
-        Print a formatted summary of the max token capacity, refill rate, current token count, and last request time of a RequestTokenBucket object.
+        Return the number of tokens a RequestTokenBucket object currently has, based on how far its theoretical_arrival_time is in the future.
 
         Parameters
         ----------
-        None
+        now : int
+            The current time, represented as nanoseconds on the monotonic clock.
 
         Returns
         -------
-        None
+        An integer representing the number of tokens currently in the bucket.
         """
-        print("Max Token Capacity: {}".format(self.max_tokens))
-        print("Refill Rate: {}".format(self.refill_rate))
-        print("Current Token Count: {}".format(self.current_count))
-        print("Last Request Time: {}".format(self.last_request_timestamp))
+        # A refill rate of 0 means tokens are replaced instantly, so the bucket is always full.
+        if not self._refill_ns:
+            return self.max_tokens
+        return (self._burst_ns - max(self.theoretical_arrival_time - now, 0)) // self._refill_ns
 
-    @classmethod
-    def __get_current_time_in_seconds(cls):
+    def try_consume(self, now):
         """
-        Return the current time represented in seconds since epoch.
+        Remove a single token from the bucket if one is available, in a thread-safe manner.
+        If a token is removed, the bucket's theoretical_arrival_time is moved forward by one refill interval.
 
         Parameters
         ----------
-        None
+        now : int
+            The current time, represented as nanoseconds on the monotonic clock.
 
         Returns
         -------
-        An integer representing the current time as seconds since epoch.
+        A tuple of a boolean denoting if a token was available and removed from the bucket, and an integer representing the number
+        of tokens left in the bucket after the request. The count is calculated while the bucket is locked, so it cannot include
+        tokens consumed afterwards by other threads.
         """
-        return int(round(time.time()))
+        # A refill rate of 0 means tokens are replaced instantly, so every request is allowed. This is checked up front because
+        # a burst window of 0 would otherwise reject any request whose time was read slightly before another thread's.
+        if not self._refill_ns:
+            return True, self.max_tokens
+        # Lock the bucket so that we do not have concurrency issues that result in us bypassing the rate limit.
+        with self.lock:
+            new_theoretical_arrival_time = max(now, self.theoretical_arrival_time) + self._refill_ns
+            if new_theoretical_arrival_time - now <= self._burst_ns:
+                self.theoretical_arrival_time = new_theoretical_arrival_time
+                return True, self.calculate_current_tokens(now)
+        # A rejected request means there were no tokens left to take.
+        return False, 0
     
-    def __time_since_last_request(self):
+    def print_bucket_summary(self):
         """
-        Return an integer representing the number of seconds since the last request made to a RequestTokenBucket object.
+        Print a formatted summary of the max token capacity, refill rate, current token count, and the number of seconds until a RequestTokenBucket object is full.
 
         Parameters
         ----------
@@ -113,9 +149,13 @@ class RequestTokenBucket(object):
 
         Returns
         -------
-        An integer representing the number of seconds since the last request made to a RequestTokenBucket object.
+        None
         """
-        return self.__get_current_time_in_seconds() - self.last_request_timestamp
+        print("Max Token Capacity: {}".format(self.max_tokens))
+        print("Refill Rate: {}".format(self.refill_rate))
+        now = time.monotonic_ns()
+        print("Current Token Count: {}".format(self.calculate_current_tokens(now)))
+        print("Seconds Until Full: {:.2f}".format(max(self.theoretical_arrival_time - now, 0) / 1_000_000_000))
     
 
 class TokenBucketRateLimiter(object):
@@ -126,6 +166,11 @@ class TokenBucketRateLimiter(object):
     ----------
     rate_limiter_dict : Dictionary
         A dictionary that maps an account ID (key) to a RequestTokenBucket object (value).
+        Lookups are not guarded by a lock; single get/set operations on a dict are already thread-safe, and each bucket
+        carries its own lock, so requests to different accounts never wait on each other.
+    verbose : bool
+        Whether information about each request should be printed. Printing is skipped entirely when running with python -O.
+        Defaults to False.
 
     Methods
     -------
@@ -135,19 +180,25 @@ class TokenBucketRateLimiter(object):
     
     allow_request_to_service(account_id):
         Determine if a request should be allowed based on the current token count of a bucket.
-        Print information about the bucket being requested and if the request will be allowed.
+        If verbose is set, print information about the bucket being requested and if the request will be allowed.
         If allowed, perform the request in a thread-safe manner.
+
+    allow_many(account_ids):
+        Determine if a request should be allowed for each account in account_ids, reading the current time only once for the whole batch.
     """
 
-    def __init__(self):
+    def __init__(self, verbose=False):
         """
         Constructor for TokenBucketRateLimiter objects.
 
         Parameters
         ----------
-        None
+        verbose : bool
+            Whether information about each request should be printed. Printing is skipped entirely when running with python -O.
+            Defaults to False.
         """
         self.rate_limiter_dict = {}
+        self.verbose = verbose
 
     def add_account(self, account_id, request_token_bucket):
         """
@@ -169,7 +220,7 @@ class TokenBucketRateLimiter(object):
     def allow_request_to_service(self, account_id):
         """
         Calculate the current number of tokens in the bucket associated with account_id, allow the request if there are enough tokens to do so, reject the request if not.
-        Print information regarding which thread is making a request, which bucket they are requesting, and the current token count of the bucket being requested.
+        If verbose is set, print information regarding which thread is making a request, which bucket they are requesting, and the current token count of the bucket being requested.
 
         Parameters
         ----------
@@ -180,22 +231,66 @@ class TokenBucketRateLimiter(object):
         -------
         A boolean denoting if the request was allowed or not.
         """
+        # Printing is done after the bucket's lock is released so that slow writes to stdout do not keep other threads waiting on the bucket.
+        allowed, remaining = self.rate_limiter_dict[account_id].try_consume(time.monotonic_ns())
+        if __debug__ and self.verbose:
+            self._print_request(account_id, allowed, remaining)
+        return allowed
+
+    def allow_many(self, account_ids):
+        """
+        Determine if a request should be allowed for each account in account_ids, reading the current time only once for the whole batch.
+        All requests in the batch are evaluated at the time the batch started. Every request is decided before anything is printed,
+        so writes to stdout do not make that time stale for the later requests in the batch.
+        If verbose is set, print the same information as allow_request_to_service for each request. The token count printed for each
+        request is the one recorded when that request was decided, not the count after the whole batch.
+
+        Parameters
+        ----------
+        account_ids : iterable of int
+            The IDs of the accounts we are making requests for, in the order the requests should be made.
+
+        Returns
+        -------
+        A list of booleans denoting if each request was allowed or not, in the same order as account_ids.
+        """
+        account_ids = tuple(account_ids)
+        rate_limiter_dict = self.rate_limiter_dict
+        now = time.monotonic_ns()
+        decisions = [rate_limiter_dict[account_id].try_consume(now) for account_id in account_ids]
+        if __debug__ and self.verbose:
+            for account_id, (allowed, remaining) in zip(account_ids, decisions):
+                self._print_request(account_id, allowed, remaining)
+        return [allowed for allowed, _ in decisions]
+
+    def _print_request(self, account_id, allowed, remaining):
+        """
+        Print information regarding which thread made a request, which bucket they requested, the remaining token count of that bucket,
+        and if the request was allowed.
+
+        Parameters
+        ----------
+        account_id : int
+            The ID of the account we are working with.
+        allowed : bool
+            Whether the request was allowed or not.
+        remaining : int
+            The number of tokens left in the bucket right after the request, as returned by RequestTokenBucket.try_consume.
+
+        Returns
+        -------
+        None
+        """
         token_bucket = self.rate_limiter_dict[account_id]
-        # Lock the bucket so that we do not have concurrency issues that result in us bypassing the rate limit.
-        with token_bucket.lock:
-            token_bucket.calculate_current_tokens()
-            print("**** {} is making a request to bucket {}****".format(threading.current_thread().name, account_id))
-            print("Current Tokens for Bucket {}: {}".format(account_id, token_bucket.current_count))
-            # Allow the request if the token bucket has at least 1 token.
-            # If the request is allowed, we will update the bucket's last_request_timestamp and remove a token from the bucket.
-            if token_bucket.current_count > 0:
-                print("Processing request\n")
-                token_bucket.last_request_timestamp = int(round(time.time()))
-                token_bucket.current_count -= 1
-                return True
-            else:
-                print("Not enough tokens to process request. Please try again in {} seconds.\n".format(token_bucket.refill_rate))
-        return False
+        if allowed:
+            outcome = "Processing request"
+        else:
+            outcome = f"Not enough tokens to process request. Please try again in {token_bucket.refill_rate} seconds."
+        # Build the whole message, including its final newline, and write it with a single call. print() would make a second
+        # write for its end argument, which lets the other thread's output land between the two.
+        sys.stdout.write(f"**** {_thread_name()} is making a request to bucket {account_id}****\n"
+                         f"Tokens Remaining in Bucket {account_id}: {remaining}\n"
+                         f"{outcome}\n\n")
         
 
 def simulate_requests(rate_limiter):
@@ -211,13 +306,15 @@ def simulate_requests(rate_limiter):
     -------
     None
     """
-    end_time = time.time() + 60
-    while time.time() < end_time:
-        rate_limiter.allow_request_to_service(1)
-        rate_limiter.allow_request_to_service(2)
+    # Resolve the methods once rather than on every iteration of the loop.
+    allow_many = rate_limiter.allow_many
+    monotonic_ns = time.monotonic_ns
+    deadline = monotonic_ns() + 60_000_000_000
+    while monotonic_ns() < deadline:
+        allow_many((1, 2))
         time.sleep(3)
 
-rate_limiter = TokenBucketRateLimiter()
+rate_limiter = TokenBucketRateLimiter(verbose=True)
 
 max_tokens_input = int(input("Please specify the maximum number of tokens the first bucket should have: "))
 refill_rate_input = int(input("Please specify the rate in seconds at which a single token should be refilled into the first bucket: "))